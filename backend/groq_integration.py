@@ -3,13 +3,26 @@ Groq AI Integration Module
 Uses Groq via OpenAI-compatible API to generate clinical pharmacogenomics explanations.
 """
 
+import asyncio
+import hashlib
 import os
-import json
-from openai import OpenAI
+import re
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional
 
+import httpx
+import orjson
+from cachetools import TTLCache
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI
+from prometheus_client import Histogram
 
-def get_client() -> OpenAI:
-    """Get OpenAI client configured for Groq with API key from environment."""
+
+@lru_cache(maxsize=1)
+def get_client() -> AsyncOpenAI:
+    """Get async OpenAI client configured for Groq with API key from environment.
+    Cached so keep-alive connections to api.groq.com are reused across requests.
+    """
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         # Fallback to checking other keys
@@ -18,28 +31,155 @@ def get_client() -> OpenAI:
     if not api_key:
         raise ValueError("GROQ_API_KEY environment variable is not set")
     
-    return OpenAI(
+    return AsyncOpenAI(
         api_key=api_key,
         base_url="https://api.groq.com/openai/v1",
+        # Retries (429, 408/409, 5xx, connection errors) are handled by _retry_delay
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        ),
     )
 
 
-def generate_clinical_explanation(
+MODEL = "llama-3.3-70b-versatile"
+SYSTEM_PROMPT = "You are a helpful clinical pharmacogenomics expert."
+
+# Upper bound on cases marshaled into one batch prompt — beyond this, latency
+# and output quality degrade faster than the per-request overhead saved.
+MAX_BATCH_SIZE = 20
+
+# Max in-flight Groq calls per process, sized to the account's RPM tier.
+MAX_CONCURRENT_CALLS = int(os.getenv("GROQ_MAX_CONCURRENCY", "10"))
+_llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+
+# Retries on HTTP 429, 408/409, 5xx (Groq's 503 "over capacity") and connection
+# errors, honouring retry-after when sent, else exponential backoff (1s, 2s, 4s)
+MAX_API_RETRIES = 3
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429})
+
+# Hard bound on one explanation (queueing, retries and generation included);
+# past this the deterministic fallback is returned instead.
+LLM_TIMEOUT_SECONDS = float(os.getenv("GROQ_TIMEOUT_SECONDS", "15"))
+
+# A batch prompt generates one explanation per case, so its budget grows with
+# the case count (20 cases: 15s + 40s, still inside the 60s httpx read timeout).
+BATCH_TIMEOUT_PER_CASE_SECONDS = float(os.getenv("GROQ_BATCH_TIMEOUT_PER_CASE_SECONDS", "2"))
+
+# Histograms need no multiprocess_mode: when PROMETHEUS_MULTIPROC_DIR is set
+# before prometheus_client is imported, samples go to per-worker files that
+# /metrics sums across workers
+GROQ_LATENCY = Histogram(
+    "groq_call_seconds",
+    "Latency of Groq chat completion calls (excluding semaphore wait)",
+    ["mode"],
+)
+
+# Explanations are fully determined by gene/diplotype/drug/risk/variants, and the
+# supported combinations number in the low hundreds — cache them for a day.
+_explanation_cache = TTLCache(maxsize=512, ttl=86400)
+
+EXPLANATION_SCHEMA = """{
+  "summary": "2-3 sentence plain English summary of why this patient has this risk",
+  "biological_mechanism": "explain how the variant affects drug metabolism at molecular level",
+  "clinical_significance": "what happens clinically if this drug is given as-is",
+  "cpic_guideline_reference": "cite the relevant CPIC guideline",
+  "alternative_recommendations": ["list", "of", "safer", "alternatives"]
+}"""
+
+
+def _format_variants(variants: list) -> str:
+    # Accepts any objects with rsid/gene/star attributes (parser Variants, API models)
+    return ", ".join([f"{v.rsid} ({v.gene}, {v.star})" for v in variants])
+
+
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def _parse_json_response(response_text: str):
+    """Extract JSON from an LLM response, tolerating markdown fences or surrounding prose."""
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        # Fallback: take the outermost {...} span
+        match = _JSON_OBJECT_RE.search(response_text)
+        if match is None:
+            raise
+        return orjson.loads(match.group(0))
+
+
+async def _complete_json(prompt: str, timeout: float = LLM_TIMEOUT_SECONDS):
+    """Send a prompt to Groq in JSON mode and return the parsed reply.
+    Concurrency is capped by a shared semaphore; transient errors are retried with backoff.
+    Raises TimeoutError if the whole exchange exceeds timeout seconds.
+    """
+    client = get_client()
+    async with asyncio.timeout(timeout):
+        for attempt in range(MAX_API_RETRIES + 1):
+            try:
+                async with _llm_semaphore, _time_groq("json"):
+                    # Using Llama 3.3 70b which is fast and very capable
+                    message = await client.chat.completions.create(
+                        model=MODEL,
+                        messages=_messages(prompt),
+                        temperature=0.7,
+                        # Ensure JSON mode if supported or just prompt for it
+                        response_format={"type": "json_object"}
+                    )
+                break
+            except (APIConnectionError, APIStatusError) as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                # Back off outside the semaphore so other calls can proceed
+                await asyncio.sleep(delay)
+    return _parse_json_response(message.choices[0].message.content)
+
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying a failed Groq call, or None if it should not be retried."""
+    if attempt == MAX_API_RETRIES:
+        return None
+    if isinstance(error, APIStatusError):
+        if error.status_code < 500 and error.status_code not in RETRYABLE_STATUS_CODES:
+            return None
+        try:
+            return float(error.response.headers["retry-after"])
+        except (KeyError, ValueError):
+            pass
+    return float(2 ** attempt)
+
+
+@asynccontextmanager
+async def _time_groq(mode: str):
+    with GROQ_LATENCY.labels(mode=mode).time():
+        yield
+
+
+def _messages(prompt: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def _cache_key(gene: str, diplotype: str, drug: str, risk_label: str, variants: list) -> str:
+    rsids = ",".join(sorted(v.rsid for v in variants))
+    return hashlib.sha1(f"{gene}|{diplotype}|{drug}|{risk_label}|{rsids}".encode()).hexdigest()
+
+
+def _build_explanation_prompt(
     gene: str,
     diplotype: str,
     phenotype: str,
     drug: str,
     risk_label: str,
     variants: list,
-) -> dict:
-    """
-    Generate a clinical explanation using Groq (Llama 3).
-    """
-    variants_str = ", ".join(
-        [f"{v.get('rsid', 'N/A')} ({v.get('gene', '')}, {v.get('star', '')})" for v in variants]
-    )
+) -> str:
+    variants_str = _format_variants(variants)
 
-    prompt = f"""You are a clinical pharmacogenomics expert. Given the following patient data, generate a structured clinical explanation.
+    return f"""You are a clinical pharmacogenomics expert. Given the following patient data, generate a structured clinical explanation.
 
 Patient Genetic Data:
 - Gene: {gene}
@@ -50,62 +190,235 @@ Patient Genetic Data:
 - Detected Variants: {variants_str}
 
 Generate a response in this EXACT JSON format:
-{{
-  "summary": "2-3 sentence plain English summary of why this patient has this risk",
-  "biological_mechanism": "explain how the variant affects drug metabolism at molecular level",
-  "clinical_significance": "what happens clinically if this drug is given as-is",
-  "cpic_guideline_reference": "cite the relevant CPIC guideline",
-  "alternative_recommendations": ["list", "of", "safer", "alternatives"]
-}}
+{EXPLANATION_SCHEMA}
 
 Be specific. Cite the rsID variants. Use clinical terminology but stay accessible."""
 
-    try:
-        client = get_client()
-        # Using Llama 3.3 70b which is fast and very capable
-        message = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {"role": "system", "content": "You are a helpful clinical pharmacogenomics expert."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            # Ensure JSON mode if supported or just prompt for it
-            response_format={"type": "json_object"}
-        )
-
-        response_text = message.choices[0].message.content
-
-        # Extract JSON from the response
-        try:
-            return json.loads(response_text)
-        except json.JSONDecodeError:
-            # Fallback extraction logic
-            json_match = response_text
-            if "```json" in response_text:
-                json_match = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                json_match = response_text.split("```")[1].split("```")[0]
-            elif "{" in response_text:
-                start = response_text.index("{")
-                end = response_text.rindex("}") + 1
-                json_match = response_text[start:end]
-
-            return json.loads(json_match)
 
+async def generate_clinical_explanation(
+    gene: str,
+    diplotype: str,
+    phenotype: str,
+    drug: str,
+    risk_label: str,
+    variants: list,
+) -> dict:
+    """
+    Generate a clinical explanation using Groq (Llama 3).
+    Non-blocking: the Groq call is awaited so the event loop keeps serving other requests.
+    """
+    key = _cache_key(gene, diplotype, drug, risk_label, variants)
+    cached = _explanation_cache.get(key)
+    if cached is not None:
+        return cached
+
+    prompt = _build_explanation_prompt(gene, diplotype, phenotype, drug, risk_label, variants)
+
+    try:
+        explanation = await _complete_json(prompt)
+        _explanation_cache[key] = explanation
+        return explanation
+    except TimeoutError:
+        print(f"ERROR: Groq API Explanation timed out after {LLM_TIMEOUT_SECONDS}s")
+        return _fallback_explanation(gene, diplotype, phenotype, drug, risk_label, "timeout", timed_out=True)
     except Exception as e:
         # Log the error for debugging in deployment environments
         print(f"ERROR: Groq API Explanation failed: {str(e)}")
-        
-        # Return a fallback explanation if API fails
-        return {
-            "summary": f"Patient carries {diplotype} diplotype in {gene}, classified as {phenotype}. "
-                       f"This results in a '{risk_label}' risk for {drug}.",
-            "biological_mechanism": f"The {gene} gene variants affect the enzyme responsible for "
-                                    f"metabolizing {drug}. The {diplotype} diplotype alters enzyme activity.",
-            "clinical_significance": f"Risk level is '{risk_label}'. Clinical guidance should be followed.",
-            "cpic_guideline_reference": f"Refer to CPIC guidelines for {gene}-{drug} interaction.",
-            "alternative_recommendations": ["Consult a clinical pharmacist for alternatives"],
-            "_error": str(e),
-            "_note": "This is a fallback explanation. Groq API was unavailable."
-        }
+        error = str(e)
+
+    # Return a fallback explanation if API fails
+    return _fallback_explanation(gene, diplotype, phenotype, drug, risk_label, error)
+
+
+async def stream_clinical_explanation(
+    gene: str,
+    diplotype: str,
+    phenotype: str,
+    drug: str,
+    risk_label: str,
+    variants: list,
+):
+    """
+    Stream a clinical explanation from Groq token by token.
+
+    Yields {"delta": str} events as tokens arrive, then one final
+    {"explanation": dict} event with the parsed JSON (or the fallback on failure).
+    JSON mode is not used here because Groq does not support it with streaming;
+    the prompt still asks for the exact schema and the reply is parsed at the end.
+    """
+    key = _cache_key(gene, diplotype, drug, risk_label, variants)
+    cached = _explanation_cache.get(key)
+    if cached is not None:
+        yield {"explanation": cached}
+        return
+
+    prompt = _build_explanation_prompt(gene, diplotype, phenotype, drug, risk_label, variants)
+    queue = asyncio.Queue()
+    chunks = []
+
+    try:
+        producer = asyncio.create_task(_pump_stream(prompt, queue))
+        try:
+            while (delta := await queue.get()) is not None:
+                chunks.append(delta)
+                yield {"delta": delta}
+            # Re-raises the producer's TimeoutError or API error
+            await producer
+        finally:
+            producer.cancel()
+
+        explanation = _parse_json_response("".join(chunks))
+        _explanation_cache[key] = explanation
+        yield {"explanation": explanation}
+        return
+    except TimeoutError:
+        print(f"ERROR: Groq API streaming explanation timed out after {LLM_TIMEOUT_SECONDS}s")
+        fallback = _fallback_explanation(gene, diplotype, phenotype, drug, risk_label, "timeout", timed_out=True)
+    except Exception as e:
+        print(f"ERROR: Groq API streaming explanation failed: {str(e)}")
+        fallback = _fallback_explanation(gene, diplotype, phenotype, drug, risk_label, str(e))
+
+    yield {"explanation": fallback}
+
+
+async def _pump_stream(prompt: str, queue: asyncio.Queue) -> None:
+    """
+    Read a streamed Groq completion into queue as text deltas, then put None.
+    Runs as its own task so the timeout, the semaphore slot and the latency
+    histogram cover the Groq side only: the timeout's cancellation lands here,
+    never in the SSE consumer's send, and a slow client never holds a slot.
+    """
+    try:
+        client = get_client()
+        sent = False
+        async with asyncio.timeout(LLM_TIMEOUT_SECONDS):
+            for attempt in range(MAX_API_RETRIES + 1):
+                try:
+                    async with _llm_semaphore, _time_groq("stream"):
+                        stream = await client.chat.completions.create(
+                            model=MODEL,
+                            messages=_messages(prompt),
+                            temperature=0.7,
+                            stream=True,
+                        )
+                        async for chunk in stream:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                queue.put_nowait(delta)
+                                sent = True
+                    break
+                except (APIConnectionError, APIStatusError) as e:
+                    # Once deltas reached the client a retry would duplicate them
+                    delay = None if sent else _retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+    finally:
+        queue.put_nowait(None)
+
+
+async def generate_clinical_explanations_batch(cases: list) -> list:
+    """
+    Generate clinical explanations for several cases with a single Groq call.
+
+    Each case is a dict with gene, diplotype, phenotype, drug, risk_label and variants.
+    Cached cases are answered from _explanation_cache; the remaining distinct cases are
+    numbered in one prompt and the model returns {"results": [...]} in the same order,
+    so N explanations cost at most one round trip instead of N.
+    """
+    keys = [
+        _cache_key(c["gene"], c["diplotype"], c["drug"], c["risk_label"], c["variants"])
+        for c in cases
+    ]
+    explanations = [_explanation_cache.get(key) for key in keys]
+
+    # Cache misses, each asked once even if repeated within the batch
+    misses = {key: c for key, c, cached in zip(keys, cases, explanations) if cached is None}
+    if not misses:
+        return explanations
+
+    error, timed_out = None, False
+    try:
+        results = await _explain_batch(list(misses.values()))
+    except TimeoutError:
+        print(f"ERROR: Groq API batch explanation timed out after {_batch_timeout(len(misses))}s")
+        error, timed_out = "timeout", True
+    except Exception as e:
+        print(f"ERROR: Groq API batch explanation failed: {str(e)}")
+        error = str(e)
+    if error is not None:
+        results = [None] * len(misses)
+
+    generated = {}
+    for (key, c), result in zip(misses.items(), results):
+        if isinstance(result, dict):
+            _explanation_cache[key] = result
+        else:
+            # A malformed element only costs its own case the fallback
+            result = _fallback_explanation(
+                c["gene"], c["diplotype"], c["phenotype"], c["drug"], c["risk_label"],
+                error or f"malformed result: {type(result).__name__}", timed_out
+            )
+        generated[key] = result
+
+    return [
+        cached if cached is not None else generated[key]
+        for key, cached in zip(keys, explanations)
+    ]
+
+
+async def _explain_batch(cases: list) -> list:
+    """Ask the model for all cases in one prompt; returns the raw results array."""
+    case_blocks = "\n\n".join(
+        f"""Case {i}:
+- Gene: {c["gene"]}
+- Diplotype: {c["diplotype"]}
+- Phenotype: {c["phenotype"]}
+- Drug: {c["drug"]}
+- Risk Level: {c["risk_label"]}
+- Detected Variants: {_format_variants(c["variants"])}"""
+        for i, c in enumerate(cases, 1)
+    )
+
+    prompt = f"""You are a clinical pharmacogenomics expert. For each of the following {len(cases)} cases, generate a structured clinical explanation.
+
+{case_blocks}
+
+Return a JSON object of the form {{"results": [...]}} where "results" is an array of exactly {len(cases)} objects, in the same order as the cases. Each object must use this EXACT JSON format:
+{EXPLANATION_SCHEMA}
+
+Be specific. Cite the rsID variants. Use clinical terminology but stay accessible."""
+
+    results = (await _complete_json(prompt, _batch_timeout(len(cases))))["results"]
+    if not isinstance(results, list) or len(results) != len(cases):
+        raise ValueError(f"expected a list of {len(cases)} results, got {results!r:.80}")
+    return results
+
+
+def _batch_timeout(n_cases: int) -> float:
+    return LLM_TIMEOUT_SECONDS + BATCH_TIMEOUT_PER_CASE_SECONDS * n_cases
+
+
+def _fallback_explanation(
+    gene: str,
+    diplotype: str,
+    phenotype: str,
+    drug: str,
+    risk_label: str,
+    error: str,
+    timed_out: bool = False,
+) -> dict:
+    """Deterministic explanation used when the Groq API is unavailable or too slow."""
+    return {
+        "summary": f"Patient carries {diplotype} diplotype in {gene}, classified as {phenotype}. "
+                   f"This results in a '{risk_label}' risk for {drug}.",
+        "biological_mechanism": f"The {gene} gene variants affect the enzyme responsible for "
+                                f"metabolizing {drug}. The {diplotype} diplotype alters enzyme activity.",
+        "clinical_significance": f"Risk level is '{risk_label}'. Clinical guidance should be followed.",
+        "cpic_guideline_reference": f"Refer to CPIC guidelines for {gene}-{drug} interaction.",
+        "alternative_recommendations": ["Consult a clinical pharmacist for alternatives"],
+        "_error": error,
+        "_note": "timeout" if timed_out else "This is a fallback explanation. Groq API was unavailable."
+    }
@@ -4,29 +4,49 @@ Pharmacogenomics analysis API.
 # Reload trigger: Migrated to Groq API.
 """
 
+import asyncio
+import io
 import os
-import uuid
+import secrets
 from datetime import datetime, timezone
-from typing import Optional
+from typing import List, Optional, Tuple
 
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-
-from vcf_parser import parse_vcf_content, group_variants_by_gene, infer_diplotype
-from risk_engine import assess_risk, GENE_DRUG_MAP, SUPPORTED_DRUGS
-from groq_integration import generate_clinical_explanation
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
+from prometheus_fastapi_instrumentator import Instrumentator
+from pydantic import BaseModel
 
+# Load .env before the local modules read their GROQ_* settings at import time
 load_dotenv()
 
+from vcf_parser import parse_vcf_content, group_variants_by_gene, infer_diplotype
+from risk_engine import assess_risk, templated_explanation, GENE_DRUG_MAP, SUPPORTED_DRUGS
+from groq_integration import (
+    generate_clinical_explanation,
+    generate_clinical_explanations_batch,
+    stream_clinical_explanation,
+    MAX_BATCH_SIZE,
+)
+
 app = FastAPI(
     title="PharmaGuard API",
     description="Pharmacogenomics analysis API — VCF parsing, risk assessment, and AI-powered clinical explanations",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
+# Per-endpoint request metrics at /metrics (Groq call latency is recorded in groq_integration).
+# With PROMETHEUS_MULTIPROC_DIR set (see Dockerfile) the endpoint aggregates all workers.
+Instrumentator().instrument(app).expose(app)
+
+# Compress JSON responses over 1KB (analysis payloads are multi-KB)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # CORS — allow frontend
 app.add_middleware(
     CORSMiddleware,
@@ -37,6 +57,47 @@ app.add_middleware(
 )
 
 
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10MB limit
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+async def _read_vcf_upload(file: UploadFile) -> io.BytesIO:
+    """
+    Read an uploaded VCF in chunks into an in-memory binary buffer.
+    Aborts as soon as the running byte count passes the size limit, instead of
+    buffering the whole upload before checking. Decoding happens line by line
+    in _parse_vcf, so the file is never held as one large str.
+    """
+    # Multipart uploads carry their size, so oversized files are rejected unread
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=400, detail="File too large (max 10MB)")
+
+    buf = io.BytesIO()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buf.write(chunk)
+        if buf.tell() > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=400, detail="File too large (max 10MB)")
+
+    buf.seek(0)
+    return buf
+
+
+def _parse_and_group(data: io.BytesIO) -> Tuple[dict, dict]:
+    parse_result = parse_vcf_content(io.TextIOWrapper(data, encoding="utf-8"))
+    return parse_result, group_variants_by_gene(parse_result["variants"])
+
+
+async def _parse_vcf(data: io.BytesIO) -> Tuple[dict, dict]:
+    """
+    Decode and parse an uploaded VCF, grouping variants by gene.
+    Runs in a worker thread — decoding and parsing are pure CPU.
+    """
+    try:
+        return await asyncio.to_thread(_parse_and_group, data)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File must be UTF-8 encoded")
+
+
 @app.get("/api/health")
 async def health_check():
     return {
@@ -47,13 +108,17 @@ async def health_check():
     }
 
 
+# Built from module constants, so serialized once at import
+_SUPPORTED_DRUGS_BODY = orjson.dumps({
+    "drugs": SUPPORTED_DRUGS,
+    "gene_drug_map": GENE_DRUG_MAP,
+})
+
+
 @app.get("/api/supported-drugs")
 async def get_supported_drugs():
     """Return the list of supported drugs."""
-    return {
-        "drugs": SUPPORTED_DRUGS,
-        "gene_drug_map": GENE_DRUG_MAP,
-    }
+    return Response(content=_SUPPORTED_DRUGS_BODY, media_type="application/json")
 
 
 @app.post("/api/parse-vcf")
@@ -62,17 +127,9 @@ async def parse_vcf(file: UploadFile = File(...)):
     Parse a VCF file and extract pharmacogenomic variants.
     Returns structured variant list per gene.
     """
-    content = await file.read()
-    try:
-        text = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="File must be UTF-8 encoded")
-
-    if len(content) > 10 * 1024 * 1024:  # 10MB limit
-        raise HTTPException(status_code=400, detail="File too large (max 10MB)")
+    data = await _read_vcf_upload(file)
 
-    result = parse_vcf_content(text)
-    grouped = group_variants_by_gene(result["variants"])
+    result, grouped = await _parse_vcf(data)
 
     # Infer diplotypes
     diplotypes = {}
@@ -110,26 +167,74 @@ async def analyze(
     Master analysis endpoint.
     Takes a VCF file + drug name → returns complete pharmacogenomic analysis with AI explanation.
     """
-    # 1. Parse VCF
+    # 1. Check the drug has a mapped gene before reading the upload
+    drug_upper = _require_supported(drug)
 
-    content = await file.read()
-    try:
-        text = content.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="File must be UTF-8 encoded")
+    # 2. Parse VCF
+    data = await _read_vcf_upload(file)
 
-    parse_result = parse_vcf_content(text)
-    grouped = group_variants_by_gene(parse_result["variants"])
+    parse_result, grouped = await _parse_vcf(data)
 
-    # 2. Find relevant gene for this drug
-    drug_upper = drug.upper()
-    primary_gene = GENE_DRUG_MAP.get(drug_upper, None)
+    return await _analyze_drug(drug_upper, grouped, parse_result)
+
+
+@app.post("/api/analyze-multi")
+async def analyze_multi(
+    file: UploadFile = File(...),
+    drugs: str = Form(...),
+):
+    """
+    Multi-drug analysis endpoint.
+    Takes a VCF file + comma-separated drug names → one full analysis per drug.
+    The per-drug AI explanations run concurrently, so wall-clock is roughly one LLM call.
+    """
+    data = await _read_vcf_upload(file)
+
+    drug_list = list(dict.fromkeys(
+        _require_supported(d.strip()) for d in drugs.split(",") if d.strip()
+    ))
+    if not drug_list:
+        raise HTTPException(status_code=400, detail="At least one drug is required")
+
+    parse_result, grouped = await _parse_vcf(data)
+
+    results = await asyncio.gather(
+        *(_analyze_drug(d, grouped, parse_result) for d in drug_list)
+    )
+    return {"results": results}
 
-    if not primary_gene:
+
+def _require_supported(drug: str) -> str:
+    """Return the upper-cased drug name, or raise 400 if it has no mapped gene."""
+    drug_upper = drug.upper()
+    if drug_upper not in GENE_DRUG_MAP:
         raise HTTPException(
             status_code=400,
             detail=f"Drug '{drug}' is not in supported list. Supported: {', '.join(SUPPORTED_DRUGS)}"
         )
+    return drug_upper
+
+
+async def _analyze_drug(drug_upper: str, grouped: dict, parse_result: dict) -> dict:
+    """Run steps 3-7 of the analysis pipeline for one supported drug."""
+    response, llm_args = _prepare_drug_analysis(drug_upper, grouped, parse_result)
+
+    # 6. Claude AI explanation
+    if llm_args:
+        response["llm_generated_explanation"] = await generate_clinical_explanation(**llm_args)
+
+    return response
+
+
+def _prepare_drug_analysis(
+    drug_upper: str, grouped: dict, parse_result: dict
+) -> Tuple[dict, Optional[dict]]:
+    """
+    Deterministic part of the pipeline (steps 3-5 and 7).
+    Returns the assembled response plus the generate_clinical_explanation kwargs —
+    or None when no LLM call is needed (no variants, or a templated low-severity result).
+    """
+    primary_gene = GENE_DRUG_MAP[drug_upper]
 
     # 3. Get variants for the primary gene
     gene_variants = grouped.get(primary_gene, [])
@@ -152,7 +257,7 @@ async def analyze(
             variants=gene_variants,
             parse_result=parse_result,
             llm_explanation=None,
-        )
+        ), None
 
     # 4. Infer diplotype
     diplotype = infer_diplotype(gene_variants)
@@ -163,15 +268,19 @@ async def analyze(
     risk_data = assess_risk(primary_gene, diplotype, drug_upper)
     phenotype = risk_data.get("phenotype", "Unknown")
 
-    # 6. Claude AI explanation
-    llm_explanation = generate_clinical_explanation(
-        gene=primary_gene,
-        diplotype=diplotype,
-        phenotype=phenotype,
-        drug=drug_upper,
-        risk_label=risk_data["risk_label"],
-        variants=gene_variants,
-    )
+    # Standard-dosing verdicts are formulaic — skip the LLM
+    llm_explanation = None
+    if risk_data["severity"] == "low":
+        llm_explanation = templated_explanation(primary_gene, diplotype, phenotype, drug_upper)
+
+    llm_args = None if llm_explanation else {
+        "gene": primary_gene,
+        "diplotype": diplotype,
+        "phenotype": phenotype,
+        "drug": drug_upper,
+        "risk_label": risk_data["risk_label"],
+        "variants": gene_variants,
+    }
 
     # 7. Assemble full response
     return _build_response(
@@ -183,9 +292,109 @@ async def analyze(
         variants=gene_variants,
         parse_result=parse_result,
         llm_explanation=llm_explanation,
+    ), llm_args
+
+
+@app.post("/api/analyze-stream")
+async def analyze_stream(
+    file: UploadFile = File(...),
+    drug: str = Form(...),
+):
+    """
+    Streaming variant of /api/analyze (Server-Sent Events).
+    The deterministic analysis is sent first as {"analysis": {...}} so the client can
+    render immediately, followed by {"delta": "..."} events for the AI explanation
+    tokens and a final {"explanation": {...}} event with the parsed JSON.
+    """
+    drug_upper = _require_supported(drug)
+    data = await _read_vcf_upload(file)
+
+    parse_result, grouped = await _parse_vcf(data)
+
+    response, llm_args = _prepare_drug_analysis(drug_upper, grouped, parse_result)
+
+    async def events():
+        yield _sse({"analysis": response})
+        if llm_args:
+            async for event in stream_clinical_explanation(**llm_args):
+                yield _sse(event)
+
+    # An explicit Content-Encoding makes GZipMiddleware pass the stream through
+    # unbuffered, so events reach the client as soon as they are produced
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Content-Encoding": "identity"},
     )
 
 
+def _sse(data: dict) -> str:
+    return f"data: {orjson.dumps(data).decode()}\n\n"
+
+
+class VariantRef(BaseModel):
+    """A detected variant as supplied to batch analysis."""
+    rsid: str = "N/A"
+    gene: str = ""
+    star: str = ""
+
+
+class AnalyzeItem(BaseModel):
+    """One case for batch analysis. Gene defaults to the drug's primary gene."""
+    drug: str
+    diplotype: str
+    gene: Optional[str] = None
+    variants: List[VariantRef] = []
+
+
+@app.post("/api/analyze-batch")
+async def analyze_batch(items: List[AnalyzeItem]):
+    """
+    Batch analysis endpoint.
+    Takes up to MAX_BATCH_SIZE (gene, diplotype, drug, variants) cases → risk assessment
+    for each, with all AI explanations generated in a single LLM call.
+    """
+    if not items:
+        raise HTTPException(status_code=400, detail="At least one case is required")
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many cases ({len(items)}), max {MAX_BATCH_SIZE} per batch"
+        )
+
+    cases = []
+    for item in items:
+        drug_upper = _require_supported(item.drug)
+        gene = item.gene.upper() if item.gene else GENE_DRUG_MAP[drug_upper]
+        risk_data = assess_risk(gene, item.diplotype, drug_upper)
+        phenotype = risk_data.get("phenotype", "Unknown")
+        explanation = None
+        if risk_data["severity"] == "low":
+            explanation = templated_explanation(gene, item.diplotype, phenotype, drug_upper)
+        cases.append({
+            "gene": gene,
+            "diplotype": item.diplotype,
+            "phenotype": phenotype,
+            "drug": drug_upper,
+            "risk_label": risk_data["risk_label"],
+            "variants": item.variants,
+            "risk_data": risk_data,
+            "explanation": explanation,
+        })
+
+    # Only cases without a templated explanation go to the LLM
+    pending = [case for case in cases if case["explanation"] is None]
+    for case, explanation in zip(pending, await generate_clinical_explanations_batch(pending)):
+        case["explanation"] = explanation
+
+    return {
+        "results": [
+            {**case["risk_data"], "llm_generated_explanation": case["explanation"]}
+            for case in cases
+        ]
+    }
+
+
 def _build_response(
     drug: str,
     primary_gene: str,
@@ -197,7 +406,7 @@ def _build_response(
     llm_explanation: Optional[dict],
 ) -> dict:
     """Build the full JSON response schema."""
-    patient_id = f"PATIENT_{uuid.uuid4().hex[:6].upper()}"
+    patient_id = f"PATIENT_{secrets.token_hex(3).upper()}"
 
     return {
         "patient_id": patient_id,
@@ -213,7 +422,7 @@ def _build_response(
             "diplotype": diplotype,
             "phenotype": phenotype,
             "detected_variants": [
-                {"rsid": v["rsid"], "gene": v["gene"], "star": v["star"]}
+                {"rsid": v.rsid, "gene": v.gene, "star": v.star}
                 for v in variants
             ],
         },
@@ -244,4 +453,5 @@ if os.path.exists(static_dir):
 
 if __name__ == "__main__":
     import uvicorn
+    # Local development entry point; production runs multi-worker via the Dockerfile
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -4,6 +4,9 @@ CPIC-guideline-based rule engine for pharmacogenomic risk assessment.
 Maps gene diplotypes → phenotypes → drug risk predictions.
 """
 
+from types import MappingProxyType
+from typing import Optional
+
 # ─── Diplotype → Phenotype mapping ───────────────────────────────────────────────
 
 PHENOTYPE_MAP = {
@@ -63,6 +66,23 @@ PHENOTYPE_MAP = {
 }
 
 
+def _with_reversed_diplotypes(gene_map: dict) -> MappingProxyType:
+    """Add the reversed form of every diplotype (*4/*1 ↔ *1/*4) and freeze."""
+    expanded = dict(gene_map)
+    for dip, phenotype in gene_map.items():
+        a, b = dip.split("/")
+        expanded.setdefault(f"{b}/{a}", phenotype)
+    return MappingProxyType(expanded)
+
+
+# Precomputed so get_phenotype is a single dict probe
+PHENOTYPE_MAP = MappingProxyType(
+    {gene: _with_reversed_diplotypes(gene_map) for gene, gene_map in PHENOTYPE_MAP.items()}
+)
+
+_EMPTY_MAP = MappingProxyType({})
+
+
 # ─── Drug Risk Lookup Table (CPIC Guidelines) ───────────────────────────────────
 
 RISK_TABLE = {
@@ -255,6 +275,9 @@ RISK_TABLE = {
     },
 }
 
+# Frozen like PHENOTYPE_MAP: entries are shared across requests and only ever copied out
+RISK_TABLE = MappingProxyType({key: MappingProxyType(risk) for key, risk in RISK_TABLE.items()})
+
 
 # ─── Gene → Drug mapping (which gene is relevant for which drug) ─────────────────
 
@@ -272,18 +295,43 @@ GENE_DRUG_MAP = {
 SUPPORTED_DRUGS = list(GENE_DRUG_MAP.keys())
 
 
-def get_phenotype(gene: str, diplotype: str) -> str:
-    """Look up phenotype from gene + diplotype."""
-    gene_map = PHENOTYPE_MAP.get(gene, {})
-    phenotype = gene_map.get(diplotype, None)
+# ─── Templated explanations for low-severity (standard dosing) results ───────────
+# These verdicts are formulaic, so they are rendered locally instead of via the LLM.
+# Only normal-function phenotypes qualify: low-severity increased-function results
+# (CYP2C19 RM/URM) still carry caveats that the "unchanged activity" text would contradict.
 
-    # Try reversed diplotype
-    if phenotype is None and "/" in diplotype:
-        parts = diplotype.split("/")
-        reversed_dip = f"{parts[1]}/{parts[0]}"
-        phenotype = gene_map.get(reversed_dip, None)
+NORMAL_FUNCTION_PHENOTYPES = frozenset({"NM", "NF"})
 
-    return phenotype if phenotype else "Unknown"
+SAFE_EXPLANATION_TEMPLATES = {
+    (gene, phenotype, drug): {
+        "biological_mechanism": f"The detected {gene} variants do not reduce the activity relevant to "
+                                f"{drug.lower()} response; the {phenotype} phenotype handles the drug as expected.",
+        "clinical_significance": f"{risk['action']}. Dosing adjustment: {risk['dosing_adjustment']}. "
+                                 f"Monitoring: {risk['monitoring']}.",
+        "cpic_guideline_reference": f"CPIC guideline for {gene} and {drug.lower()}: "
+                                    f"{phenotype} — {risk['action'].lower()}.",
+        "alternative_recommendations": ["No alternative required — standard therapy is appropriate"],
+    }
+    for (gene, phenotype, drug), risk in RISK_TABLE.items()
+    if risk["severity"] == "low" and phenotype in NORMAL_FUNCTION_PHENOTYPES
+}
+
+
+def templated_explanation(gene: str, diplotype: str, phenotype: str, drug: str) -> Optional[dict]:
+    """Render the precomputed explanation for a low-severity normal-function result, or None."""
+    template = SAFE_EXPLANATION_TEMPLATES.get((gene, phenotype, drug))
+    if template is None:
+        return None
+    return {
+        "summary": f"Patient carries {diplotype} diplotype in {gene}, classified as {phenotype}. "
+                   f"No clinically significant change in {drug.lower()} response is expected.",
+        **template,
+    }
+
+
+def get_phenotype(gene: str, diplotype: str) -> str:
+    """Look up phenotype from gene + diplotype (either allele order)."""
+    return PHENOTYPE_MAP.get(gene, _EMPTY_MAP).get(diplotype, "Unknown")
 
 
 def assess_risk(gene: str, diplotype: str, drug: str) -> dict:
@@ -7,104 +7,153 @@ Supports ALL VCF formats (v3.x, v4.x, etc.) and real-world VCF files
 that don't have custom GENE/STAR/RS INFO tags — uses rsID lookup.
 """
 
-from typing import Optional
-import re
+from bisect import bisect_right
+from collections import defaultdict
+from dataclasses import dataclass
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Union
+import io
 
-TARGET_GENES = {"CYP2D6", "CYP2C19", "CYP2C9", "SLCO1B1", "TPMT", "DPYD"}
+TARGET_GENES = frozenset({"CYP2D6", "CYP2C19", "CYP2C9", "SLCO1B1", "TPMT", "DPYD"})
+
+
+@dataclass(slots=True)
+class Variant:
+    """A pharmacogenomic variant extracted from one VCF record.
+    Slotted to keep per-row memory small; serializes to a JSON object like a dict.
+    """
+    rsid: str
+    gene: str
+    star: str
+    chrom: str
+    pos: int
+    ref: str
+    alt: str
 
 
 # ─── rsID → Gene/Star allele lookup table ────────────────────────────────────
 # This allows parsing real-world VCF files that don't have custom INFO tags.
 # Based on PharmVar / dbSNP / CPIC variant-star allele mappings.
-RSID_LOOKUP = {
+# Rows are flattened into RSID_TO_GENE / RSID_TO_STAR below.
+_RSID_ALLELES = [
     # CYP2D6 variants
-    "rs3892097":  {"gene": "CYP2D6",  "star": "*4"},    # CYP2D6*4 — splicing defect
-    "rs1065852":  {"gene": "CYP2D6",  "star": "*4"},    # CYP2D6*4 — 100C>T
-    "rs5030655":  {"gene": "CYP2D6",  "star": "*6"},    # CYP2D6*6 — frameshift
-    "rs16947":    {"gene": "CYP2D6",  "star": "*2"},    # CYP2D6*2 — R296C
-    "rs1135840":  {"gene": "CYP2D6",  "star": "*2"},    # CYP2D6*2 — S486T
-    "rs28371706": {"gene": "CYP2D6",  "star": "*17"},   # CYP2D6*17
-    "rs28371725": {"gene": "CYP2D6",  "star": "*41"},   # CYP2D6*41 — reduced function
-    "rs35742686": {"gene": "CYP2D6",  "star": "*3"},    # CYP2D6*3 — frameshift
-    "rs5030867":  {"gene": "CYP2D6",  "star": "*7"},    # CYP2D6*7
-    "rs5030865":  {"gene": "CYP2D6",  "star": "*8"},    # CYP2D6*8
-    "rs1080985":  {"gene": "CYP2D6",  "star": "*2"},    # CYP2D6*2 upstream variant
-    "rs28371703": {"gene": "CYP2D6",  "star": "*15"},   # CYP2D6*15
-    "rs769258":   {"gene": "CYP2D6",  "star": "*5"},    # CYP2D6*5
+    ("rs3892097",  "CYP2D6",  "*4"),      # CYP2D6*4 — splicing defect
+    ("rs1065852",  "CYP2D6",  "*4"),      # CYP2D6*4 — 100C>T
+    ("rs5030655",  "CYP2D6",  "*6"),      # CYP2D6*6 — frameshift
+    ("rs16947",    "CYP2D6",  "*2"),      # CYP2D6*2 — R296C
+    ("rs1135840",  "CYP2D6",  "*2"),      # CYP2D6*2 — S486T
+    ("rs28371706", "CYP2D6",  "*17"),     # CYP2D6*17
+    ("rs28371725", "CYP2D6",  "*41"),     # CYP2D6*41 — reduced function
+    ("rs35742686", "CYP2D6",  "*3"),      # CYP2D6*3 — frameshift
+    ("rs5030867",  "CYP2D6",  "*7"),      # CYP2D6*7
+    ("rs5030865",  "CYP2D6",  "*8"),      # CYP2D6*8
+    ("rs1080985",  "CYP2D6",  "*2"),      # CYP2D6*2 upstream variant
+    ("rs28371703", "CYP2D6",  "*15"),     # CYP2D6*15
+    ("rs769258",   "CYP2D6",  "*5"),      # CYP2D6*5
 
     # CYP2C19 variants
-    "rs4244285":  {"gene": "CYP2C19", "star": "*2"},    # CYP2C19*2 — splicing defect
-    "rs4986893":  {"gene": "CYP2C19", "star": "*3"},    # CYP2C19*3 — premature stop
-    "rs12248560": {"gene": "CYP2C19", "star": "*17"},   # CYP2C19*17 — ultra-rapid
-    "rs28399504": {"gene": "CYP2C19", "star": "*4"},    # CYP2C19*4
-    "rs56337013": {"gene": "CYP2C19", "star": "*5"},    # CYP2C19*5
-    "rs72552267": {"gene": "CYP2C19", "star": "*6"},    # CYP2C19*6
-    "rs72558186": {"gene": "CYP2C19", "star": "*7"},    # CYP2C19*7
-    "rs41291556": {"gene": "CYP2C19", "star": "*8"},    # CYP2C19*8
+    ("rs4244285",  "CYP2C19", "*2"),      # CYP2C19*2 — splicing defect
+    ("rs4986893",  "CYP2C19", "*3"),      # CYP2C19*3 — premature stop
+    ("rs12248560", "CYP2C19", "*17"),     # CYP2C19*17 — ultra-rapid
+    ("rs28399504", "CYP2C19", "*4"),      # CYP2C19*4
+    ("rs56337013", "CYP2C19", "*5"),      # CYP2C19*5
+    ("rs72552267", "CYP2C19", "*6"),      # CYP2C19*6
+    ("rs72558186", "CYP2C19", "*7"),      # CYP2C19*7
+    ("rs41291556", "CYP2C19", "*8"),      # CYP2C19*8
 
     # CYP2C9 variants
-    "rs1799853":  {"gene": "CYP2C9",  "star": "*2"},    # CYP2C9*2 — R144C
-    "rs1057910":  {"gene": "CYP2C9",  "star": "*3"},    # CYP2C9*3 — I359L
-    "rs28371686": {"gene": "CYP2C9",  "star": "*5"},    # CYP2C9*5
-    "rs9332131":  {"gene": "CYP2C9",  "star": "*6"},    # CYP2C9*6
-    "rs28371685": {"gene": "CYP2C9",  "star": "*11"},   # CYP2C9*11
+    ("rs1799853",  "CYP2C9",  "*2"),      # CYP2C9*2 — R144C
+    ("rs1057910",  "CYP2C9",  "*3"),      # CYP2C9*3 — I359L
+    ("rs28371686", "CYP2C9",  "*5"),      # CYP2C9*5
+    ("rs9332131",  "CYP2C9",  "*6"),      # CYP2C9*6
+    ("rs28371685", "CYP2C9",  "*11"),     # CYP2C9*11
 
     # SLCO1B1 variants
-    "rs4149056":  {"gene": "SLCO1B1", "star": "*5"},    # SLCO1B1*5 — V174A
-    "rs2306283":  {"gene": "SLCO1B1", "star": "*1b"},   # SLCO1B1*1b — N130D
-    "rs4149015":  {"gene": "SLCO1B1", "star": "*15"},   # SLCO1B1*15
-    "rs11045819": {"gene": "SLCO1B1", "star": "*1b"},   # SLCO1B1 P155T
+    ("rs4149056",  "SLCO1B1", "*5"),      # SLCO1B1*5 — V174A
+    ("rs2306283",  "SLCO1B1", "*1b"),     # SLCO1B1*1b — N130D
+    ("rs4149015",  "SLCO1B1", "*15"),     # SLCO1B1*15
+    ("rs11045819", "SLCO1B1", "*1b"),     # SLCO1B1 P155T
 
     # TPMT variants
-    "rs1800462":  {"gene": "TPMT",    "star": "*2"},    # TPMT*2 — A80P
-    "rs1800460":  {"gene": "TPMT",    "star": "*3A"},   # TPMT*3A — A154T
-    "rs1142345":  {"gene": "TPMT",    "star": "*3A"},   # TPMT*3A — Y240C
-    "rs1800584":  {"gene": "TPMT",    "star": "*3B"},   # TPMT*3B
-    "rs1800584":  {"gene": "TPMT",    "star": "*3C"},   # TPMT*3C — Y240C only
+    ("rs1800462",  "TPMT",    "*2"),      # TPMT*2 — A80P
+    ("rs1800460",  "TPMT",    "*3A"),     # TPMT*3A — A154T
+    ("rs1142345",  "TPMT",    "*3A"),     # TPMT*3A — Y240C
+    # rs1800584 used to appear twice (*3B then *3C); only *3C ever took effect
+    ("rs1800584",  "TPMT",    "*3C"),     # TPMT*3C — Y240C only
 
     # DPYD variants
-    "rs3918290":  {"gene": "DPYD",    "star": "*2A"},   # DPYD*2A — IVS14+1G>A (critical)
-    "rs55886062": {"gene": "DPYD",    "star": "*13"},   # DPYD*13 — I560S
-    "rs67376798": {"gene": "DPYD",    "star": "*HapB3"},# DPYD HapB3 — D949V
-    "rs75017182": {"gene": "DPYD",    "star": "*HapB3"},# DPYD HapB3 upstream
-    "rs56038477": {"gene": "DPYD",    "star": "*HapB3"},# DPYD HapB3 intronic
-}
+    ("rs3918290",  "DPYD",    "*2A"),     # DPYD*2A — IVS14+1G>A (critical)
+    ("rs55886062", "DPYD",    "*13"),     # DPYD*13 — I560S
+    ("rs67376798", "DPYD",    "*HapB3"),  # DPYD HapB3 — D949V
+    ("rs75017182", "DPYD",    "*HapB3"),  # DPYD HapB3 upstream
+    ("rs56038477", "DPYD",    "*HapB3"),  # DPYD HapB3 intronic
+]
+
+
+def _build_rsid_maps(alleles: list) -> tuple:
+    """Flatten (rsid, gene, star) rows into two rsid → str maps, rejecting duplicates."""
+    to_gene, to_star = {}, {}
+    for rsid, gene, star in alleles:
+        if rsid in to_gene:
+            raise ValueError(f"Duplicate rsID in lookup table: {rsid}")
+        to_gene[rsid] = gene
+        to_star[rsid] = star
+    return to_gene, to_star
+
+
+RSID_TO_GENE, RSID_TO_STAR = _build_rsid_maps(_RSID_ALLELES)
+
 
 # ─── Known pharmacogenomic positions (chrom:pos → gene) ─────────────────────
-# Fallback if rsID is unknown but position matches a pharma gene region
+# Fallback if rsID is unknown but position matches a pharma gene region.
+# Chromosomes are stored without the "chr" prefix; lookups strip it.
 POSITION_GENE_MAP = {
     # CYP2D6 on chr22 (GRCh37: ~42,522,000-42,527,000 / GRCh38: ~42,126,000-42,131,000)
-    ("chr22", 42522000, 42528000): "CYP2D6",
     ("22", 42522000, 42528000): "CYP2D6",
-    ("chr22", 42126000, 42132000): "CYP2D6",
     ("22", 42126000, 42132000): "CYP2D6",
 
     # CYP2C19 on chr10 (GRCh37: ~96,520,000-96,613,000 / GRCh38: ~94,762,000-94,855,000)
-    ("chr10", 96520000, 96614000): "CYP2C19",
     ("10", 96520000, 96614000): "CYP2C19",
-    ("chr10", 94762000, 94856000): "CYP2C19",
     ("10", 94762000, 94856000): "CYP2C19",
 
     # CYP2C9 on chr10 (GRCh37: ~96,698,000-96,750,000 / GRCh38: ~94,938,000-94,990,000)
-    ("chr10", 96698000, 96751000): "CYP2C9",
     ("10", 96698000, 96751000): "CYP2C9",
-    ("chr10", 94938000, 94991000): "CYP2C9",
     ("10", 94938000, 94991000): "CYP2C9",
 
     # SLCO1B1 on chr12 (GRCh37: ~21,283,000-21,393,000)
-    ("chr12", 21283000, 21394000): "SLCO1B1",
     ("12", 21283000, 21394000): "SLCO1B1",
 
     # TPMT on chr6 (GRCh37: ~18,128,000-18,155,000)
-    ("chr6", 18128000, 18156000): "TPMT",
     ("6", 18128000, 18156000): "TPMT",
 
     # DPYD on chr1 (GRCh37: ~97,543,000-97,921,000)
-    ("chr1", 97543000, 97922000): "DPYD",
     ("1", 97543000, 97922000): "DPYD",
 }
 
 
+def _build_position_index(position_map: dict) -> dict:
+    """Build chrom → (starts, ends, genes) with intervals sorted by start.
+    Intervals on a chromosome must not overlap, so the only candidate for a
+    position is the last interval starting at or before it.
+    """
+    by_chrom = {}
+    for (chrom, start, end), gene in position_map.items():
+        by_chrom.setdefault(chrom, []).append((start, end, gene))
+
+    index = {}
+    for chrom, intervals in by_chrom.items():
+        intervals.sort()
+        for (_, prev_end, prev_gene), (start, _, gene) in zip(intervals, intervals[1:]):
+            if start <= prev_end:
+                raise ValueError(f"Overlapping gene regions on {chrom}: {prev_gene} and {gene}")
+        starts, ends, genes = zip(*intervals)
+        index[chrom] = (starts, ends, genes)
+    return index
+
+
+POSITION_INDEX = _build_position_index(POSITION_GENE_MAP)
+
+
 def parse_info_field(info: str) -> dict:
     """Parse VCF INFO field into key-value pairs.
     Example: GENE=CYP2D6;STAR=*4;RS=rs3892097 → {GENE: CYP2D6, STAR: *4, RS: rs3892097}
@@ -125,22 +174,34 @@ def parse_info_field(info: str) -> dict:
 
 def lookup_by_rsid(rsid: str) -> Optional[dict]:
     """Look up gene and star allele from rsID."""
-    return RSID_LOOKUP.get(rsid, None)
+    gene = RSID_TO_GENE.get(rsid)
+    if gene is None:
+        return None
+    return {"gene": gene, "star": RSID_TO_STAR[rsid]}
 
 
 def lookup_by_position(chrom: str, pos: int) -> Optional[str]:
-    """Look up gene by genomic position (fallback)."""
-    for (c, start, end), gene in POSITION_GENE_MAP.items():
-        if chrom == c and start <= pos <= end:
-            return gene
+    """Look up gene by genomic position (fallback). Binary search per chromosome."""
+    if chrom[:3] == "chr":
+        chrom = chrom[3:]
+    intervals = POSITION_INDEX.get(chrom)
+    if intervals is None:
+        return None
+    starts, ends, genes = intervals
+    i = bisect_right(starts, pos) - 1
+    if i >= 0 and pos <= ends[i]:
+        return genes[i]
     return None
 
 
-def parse_vcf_content(content: str) -> dict:
+def parse_vcf_content(content: Union[str, Iterable[str]]) -> dict:
     """
     Parse VCF file content and extract pharmacogenomic variants.
     Works with ALL VCF versions and real-world files.
 
+    `content` is either the full text or any iterable of lines, e.g. a text
+    stream — lines are consumed one at a time, never collected into a list.
+
     Strategy:
     1. If custom GENE/STAR/RS INFO tags exist → use them directly
     2. Else, look up rsID in our pharmacogenomic database
@@ -162,16 +223,38 @@ def parse_vcf_content(content: str) -> dict:
     total_lines = 0
     vcf_version = "Unknown"
 
-    lines = content.strip().split("\n")
-
-    for line_num, line in enumerate(lines, 1):
-        # Extract VCF version from header
-        if line.startswith("##fileformat="):
-            vcf_version = line.split("=", 1)[1].strip()
+    lines = io.StringIO(content) if isinstance(content, str) else content
+
+    # Bind globals and bound methods to locals for the per-line loop
+    rsid_to_gene = RSID_TO_GENE
+    rsid_to_star = RSID_TO_STAR
+    target_genes = TARGET_GENES
+    lookup_position = lookup_by_position
+    add_variant = variants.append
+    add_gene = genes_found.add
+    # chrom/ref/alt (and INFO-tag gene/star) take few distinct values, so emitted
+    # variants share one str object per value. Table-derived gene/star already do.
+    canonical = {}.setdefault
+
+    numbered = enumerate(lines, 1)
+
+    # Header pass: meta lines and the column header, up to the first record
+    first_record = None
+    for line_num, line in numbered:
+        if line[:1] == "#":
+            # Extract VCF version from header
+            if line[:13] == "##fileformat=":
+                vcf_version = line[13:].strip()
             continue
-
-        # Skip headers and comments
-        if line.startswith("#"):
+        if line.strip():
+            first_record = (line_num, line)
+            break
+
+    # Body pass: data records only
+    records = chain((first_record,), numbered) if first_record else ()
+    for line_num, line in records:
+        # Skip stray comment lines
+        if line[:1] == "#":
             continue
 
         line = line.strip()
@@ -179,10 +262,11 @@ def parse_vcf_content(content: str) -> dict:
             continue
 
         total_lines += 1
-        parts = line.split("\t")
+        # Only CHROM..INFO are used; maxsplit leaves FORMAT + sample columns unsplit
+        parts = line.split("\t", 8)
         if len(parts) < 8:
-            # Try splitting by multiple spaces/whitespace
-            parts = re.split(r"\s+", line)
+            # Try splitting by runs of whitespace
+            parts = line.split(None, 8)
 
         if len(parts) < 5:
             # Minimum VCF: CHROM POS ID REF ALT
@@ -204,48 +288,56 @@ def parse_vcf_content(content: str) -> dict:
             parsing_errors.append(f"Line {line_num}: invalid position '{pos_str}'")
             continue
 
-        info_dict = parse_info_field(info)
-
         gene = None
         star = ""
         variant_rsid = rsid
 
         # ── Strategy 1: Custom INFO tags ──
-        if "GENE" in info_dict:
-            gene = info_dict["GENE"].upper()
-            star = info_dict.get("STAR", "")
-            variant_rsid = info_dict.get("RS", rsid)
+        # Only GENE/STAR/RS are read, so skip parsing INFO unless GENE can be present
+        if "GENE" in info:
+            info_gene = info_star = info_rs = None
+            for item in info.split(";"):
+                key, has_value, value = item.partition("=")
+                if not has_value:
+                    continue
+                key = key.strip()
+                if key == "GENE":
+                    info_gene = value.strip()
+                elif key == "STAR":
+                    info_star = value.strip()
+                elif key == "RS":
+                    info_rs = value.strip()
+            if info_gene is not None:
+                gene = info_gene.upper()
+                gene = canonical(gene, gene)
+                star = canonical(info_star, info_star) if info_star else ""
+                variant_rsid = info_rs if info_rs is not None else rsid
 
         # ── Strategy 2: rsID lookup ──
-        if gene is None and rsid != "." and rsid.startswith("rs"):
-            lookup = lookup_by_rsid(rsid)
-            if lookup:
-                gene = lookup["gene"]
-                star = lookup["star"]
+        # Non-rs IDs (including ".") simply miss the dict
+        if gene is None:
+            gene = rsid_to_gene.get(rsid)
+            if gene is not None:
+                star = rsid_to_star[rsid]
                 variant_rsid = rsid
 
         # ── Strategy 3: Position-based lookup (fallback) ──
         if gene is None:
-            pos_gene = lookup_by_position(chrom, pos_int)
+            pos_gene = lookup_position(chrom, pos_int)
             if pos_gene:
                 gene = pos_gene
                 variant_rsid = rsid if rsid != "." else f"pos_{chrom}_{pos_int}"
 
         # Skip if not a pharmacogenomic variant
-        if gene is None or gene not in TARGET_GENES:
+        if gene is None or gene not in target_genes:
             continue
 
-        genes_found.add(gene)
+        add_gene(gene)
 
-        variants.append({
-            "rsid": variant_rsid,
-            "gene": gene,
-            "star": star,
-            "chrom": chrom,
-            "pos": pos_int,
-            "ref": ref,
-            "alt": alt,
-        })
+        add_variant(Variant(
+            variant_rsid, gene, star,
+            canonical(chrom, chrom), pos_int, canonical(ref, ref), canonical(alt, alt),
+        ))
 
     return {
         "variants": variants,
@@ -257,28 +349,22 @@ def parse_vcf_content(content: str) -> dict:
     }
 
 
-def group_variants_by_gene(variants: list) -> dict:
+def group_variants_by_gene(variants: List[Variant]) -> Dict[str, List[Variant]]:
     """Group variants by gene for downstream analysis."""
-    grouped = {}
+    grouped = defaultdict(list)
     for v in variants:
-        gene = v["gene"]
-        if gene not in grouped:
-            grouped[gene] = []
-        grouped[gene].append(v)
-    return grouped
+        grouped[v.gene].append(v)
+    return dict(grouped)
 
 
-def infer_diplotype(gene_variants: list) -> Optional[str]:
+def infer_diplotype(gene_variants: List[Variant]) -> Optional[str]:
     """
     Infer diplotype from a list of variants for a single gene.
     Uses star alleles found in the variants. If two distinct star alleles are found,
     returns them as a diplotype. If only one is found, duplicates it (homozygous assumption).
     """
-    stars = []
-    for v in gene_variants:
-        star = v.get("star", "")
-        if star and star not in stars:
-            stars.append(star)
+    # Distinct non-empty stars, in first-seen order
+    stars = list(dict.fromkeys(v.star for v in gene_variants if v.star))
 
     if len(stars) == 0:
         return None